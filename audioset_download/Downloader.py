@@ -1,6 +1,42 @@
 import os
-import joblib
+import shutil
+import hashlib
+import threading
+import concurrent.futures
+import urllib.request
 import pandas as pd
+import yt_dlp
+from yt_dlp.postprocessor import FFmpegExtractAudioPP
+from tqdm import tqdm
+
+# extension of the files written by yt-dlp for each --audio-format
+_FORMAT_EXT = {
+    'vorbis': 'ogg',
+    'aac': 'm4a',
+    'alac': 'm4a',
+    'm4a': 'm4a',
+    'mp3': 'mp3',
+    'opus': 'opus',
+    'flac': 'flac',
+    'wav': 'wav',
+}
+
+class _TqdmLogger:
+    """
+    yt-dlp logger that drops the progress messages and prints the errors above the progress bar.
+    """
+
+    def debug(self, msg):
+        pass
+
+    def info(self, msg):
+        pass
+
+    def warning(self, msg):
+        pass
+
+    def error(self, msg):
+        tqdm.write(msg)
 
 class Downloader:
     """
@@ -14,26 +50,59 @@ class Downloader:
                     n_jobs: int = 1,
                     download_type: str = 'unbalanced_train',
                     copy_and_replicate: bool = True,
+                    cache_dir: str = None, # None to use ~/.cache/audioset-download
                     ):
         """
         This method initializes the class.
         :param root_path: root path of the dataset
         :param labels: list of labels to download
-        :param n_jobs: number of parallel jobs
+        :param n_jobs: number of parallel jobs, negative values count back from the number of CPUs (-1 uses all of them)
         :param download_type: type of download (unbalanced_train, balanced_train, eval)
-        :param copy_and_replicate: if True, the audio file is copied and replicated for each label. 
+        :param copy_and_replicate: if True, the audio file is replicated (hardlinked) for each label. 
                                     If False, the audio file is stored only once in the folder corresponding to the first label.
+        :param cache_dir: directory where the AudioSet metadata files are cached between runs.
         """
         # Set the parameters
         self.root_path = root_path
         self.labels = labels
+        if n_jobs == 0:
+            raise ValueError('n_jobs must not be 0')
+        if n_jobs < 0:
+            # same convention as joblib: -1 is all the CPUs, -2 all but one, ...
+            n_jobs = max((os.cpu_count() or 1) + 1 + n_jobs, 1)
         self.n_jobs = n_jobs
         self.download_type = download_type
         self.copy_and_replicate = copy_and_replicate
+        if cache_dir is None:
+            cache_dir = os.path.join(os.path.expanduser('~'), '.cache', 'audioset-download')
+        self.cache_dir = cache_dir
 
-        # Create the path
+        # Create the paths
         os.makedirs(self.root_path, exist_ok=True)
+        os.makedirs(self.cache_dir, exist_ok=True)
         self.read_class_mapping()
+        self._label_dir = {mid: os.path.join(self.root_path, display_label) for mid, display_label in self.machine_to_display_mapping.items()}
+
+    def _cached_read_csv(self, url: str, **kwargs) -> pd.DataFrame:
+        """
+        This method reads a remote csv file, downloading it only if it is not already in the cache.
+        :param url: URL of the csv file.
+        :param kwargs: additional arguments passed to pd.read_csv.
+        :return: content of the csv file
+        """
+        path = os.path.join(self.cache_dir, hashlib.md5(url.encode()).hexdigest() + '.csv')
+        if not os.path.exists(path):
+            # download to a temporary file so that an interrupted run does not leave a truncated cache
+            tmp_path = f'{path}.{os.getpid()}.tmp'
+            try:
+                with urllib.request.urlopen(url) as response, open(tmp_path, 'wb') as f:
+                    shutil.copyfileobj(response, f)
+                os.replace(tmp_path, path)
+            except BaseException:
+                if os.path.exists(tmp_path):
+                    os.remove(tmp_path)
+                raise
+        return pd.read_csv(path, **kwargs)
 
     def read_class_mapping(self):
         """
@@ -41,7 +110,7 @@ class Downloader:
         :return: class mapping
         """
 
-        class_df = pd.read_csv(
+        class_df = self._cached_read_csv(
             f"http://storage.googleapis.com/us_audioset/youtube_corpus/v1/csv/class_labels_indices.csv", 
             sep=',',
         )
@@ -57,44 +126,111 @@ class Downloader:
     ):
         """
         This method downloads the dataset using the provided parameters.
-        :param format: format of the audio file (vorbis, mp3, m4a, wav), default is vorbis
+        :param format: format of the audio file (vorbis, mp3, m4a, aac, alac, opus, flac, wav), default is vorbis
         :param quality: quality of the audio file (0: best, 10: worst), default is 5
         """
 
+        if format not in FFmpegExtractAudioPP.SUPPORTED_EXTS:
+            raise ValueError(f'Unsupported audio format {format!r}, expected one of {", ".join(FFmpegExtractAudioPP.SUPPORTED_EXTS)}')
         self.format = format
         self.quality = quality
 
         # Load the metadata
-        metadata = pd.read_csv(
+        metadata = self._cached_read_csv(
             f"http://storage.googleapis.com/us_audioset/youtube_corpus/v1/csv/{self.download_type}_segments.csv", 
-            sep=', ', 
+            sep=',', 
+            skipinitialspace=True, # fields are separated by ', '
             skiprows=3,
             header=None,
             names=['YTID', 'start_seconds', 'end_seconds', 'positive_labels'],
-            engine='python'
+            engine='c'
         )
+        # remove " in the labels and split them once into lists of machine ids
+        metadata['positive_labels'] = metadata['positive_labels'].str.replace('"', '', regex=False).str.split(',')
+        # only keep well-formed YouTube IDs, they are used to build file paths and URLs
+        metadata = metadata[metadata['YTID'].str.fullmatch(r'[A-Za-z0-9_-]{11}')]
         if self.labels is not None:
             self.real_labels = [self.display_to_machine_mapping[label] for label in self.labels]
-            metadata = metadata[metadata['positive_labels'].apply(lambda x: any([label in x for label in self.real_labels]))]
-            # remove " in the labels
-        metadata['positive_labels'] = metadata['positive_labels'].apply(lambda x: x.replace('"', ''))
+            # keep the clips having at least one of the requested labels
+            wanted = set(self.real_labels)
+            metadata = metadata[~metadata['positive_labels'].map(wanted.isdisjoint)]
+        # merge the labels of repeated segments so that each clip is downloaded once
+        segment_key = ['YTID', 'start_seconds', 'end_seconds']
+        if metadata.duplicated(subset=segment_key).any():
+            metadata = metadata.groupby(segment_key, sort=False)['positive_labels'].agg(
+                lambda x: list(dict.fromkeys(label for labels in x for label in labels))
+            ).reset_index()
         metadata = metadata.reset_index(drop=True)
 
+        # Resolve the label folders each file will be stored in, the first one holds the downloaded file
+        label_dir = self._label_dir
+        if self.copy_and_replicate:
+            metadata['label_dirs'] = metadata['positive_labels'].map(lambda labels: [label_dir[label] for label in labels])
+        else:
+            metadata['label_dirs'] = metadata['positive_labels'].map(lambda labels: [label_dir[labels[0]]])
+
+        # Create the path for each label a file will be stored in
+        for path in metadata['label_dirs'].explode().unique():
+            os.makedirs(path, exist_ok=True)
+
+        # Skip the files already downloaded and replicated by a previous run
+        ext = _FORMAT_EXT[self.format]
+        file_names = (
+            metadata['YTID'] + '_' + metadata['start_seconds'].astype(str) + '-' + metadata['end_seconds'].astype(str) + '.' + ext
+        )
+        label_dirs = metadata['label_dirs'].explode()
+        paths = label_dirs + os.sep + file_names.reindex(label_dirs.index)
+        done = paths.map(os.path.exists).astype(bool).groupby(level=0).all().reindex(metadata.index, fill_value=False)
+        if done.any():
+            print(f'Resuming, {done.sum()} files already downloaded.')
+            metadata = metadata[~done].reset_index(drop=True)
+
         print(f'Downloading {len(metadata)} files...')
 
         # Download the dataset
-        joblib.Parallel(n_jobs=self.n_jobs, verbose=10)(
-            joblib.delayed(self.download_file)(metadata.loc[i, 'YTID'], metadata.loc[i, 'start_seconds'], metadata.loc[i, 'end_seconds'], metadata.loc[i, 'positive_labels']) for i in range(len(metadata))
-        )
+        self._download_all(metadata)
 
         print('Done.')
 
+    def _download_all(self, metadata: pd.DataFrame):
+        """
+        This method downloads all the files in the metadata, running at most n_jobs downloads at the same time.
+        :param metadata: metadata of the audio clips to download.
+        """
+        # the workers share one lazy iterator, so rows are only materialized when a worker is free
+        rows = metadata[['YTID', 'start_seconds', 'end_seconds', 'label_dirs']].itertuples(index=False, name=None)
+        rows_lock = threading.Lock()
+        with tqdm(total=len(metadata), unit='file') as pbar, \
+                concurrent.futures.ThreadPoolExecutor(max_workers=self.n_jobs) as executor:
+            workers = [executor.submit(self._download_worker, rows, rows_lock, pbar) for _ in range(self.n_jobs)]
+            for worker in workers:
+                worker.result()
+
+    def _download_worker(self, rows, rows_lock: threading.Lock, pbar: tqdm):
+        """
+        This method downloads the rows of the metadata one at a time until none is left.
+        :param rows: iterator over (YTID, start_seconds, end_seconds, label_dirs) tuples, shared by all the workers.
+        :param rows_lock: lock guarding the shared iterator.
+        :param pbar: progress bar updated when each download is over.
+        """
+        while True:
+            with rows_lock:
+                row = next(rows, None)
+            if row is None:
+                return
+            try:
+                self.download_file(*row)
+            except Exception as e:
+                # a failing clip must not stop the other downloads
+                tqdm.write(f'Failed to download {row[0]}: {e!r}')
+            pbar.update()
+
     def download_file(
             self, 
             ytid: str, 
             start_seconds: float,
             end_seconds: float,
-            positive_labels: str,
+            label_dirs: list,
         ):
         """
         This method downloads a single file. It only download the audio file at 16kHz.
@@ -102,26 +238,72 @@ class Downloader:
         :param ytid: YouTube ID.
         :param start_seconds: start time of the audio clip.
         :param end_seconds: end time of the audio clip.
-        :param positive_labels: labels associated with the audio clip.
+        :param label_dirs: label folders the audio clip is stored in, the first one holds the downloaded file.
         """
 
-        # Create the path for each label that is associated with the file
-        if self.copy_and_replicate:
-            for label in positive_labels.split(','):
-                display_label = self.machine_to_display_mapping[label]
-                os.makedirs(os.path.join(self.root_path, display_label), exist_ok=True)
-        else:
-            display_label = self.machine_to_display_mapping[positive_labels.split(',')[0]]
-            os.makedirs(os.path.join(self.root_path, display_label), exist_ok=True)
-
         # Download the file using yt-dlp
         # store in the folder of the first label
-        first_display_label = self.machine_to_display_mapping[positive_labels.split(',')[0]]
-        os.system(f'yt-dlp -x --audio-format {self.format} --audio-quality {self.quality} --output "{os.path.join(self.root_path, first_display_label, ytid)}_{start_seconds}-{end_seconds}.%(ext)s" --postprocessor-args "-ss {start_seconds} -to {end_seconds}" https://www.youtube.com/watch?v={ytid}')
-        
-        if self.copy_and_replicate:
-            # copy the file in the other folders
-            for label in positive_labels.split(',')[1:]:
-                display_label = self.machine_to_display_mapping[label]
-                os.system(f'cp "{os.path.join(self.root_path, first_display_label, ytid)}_{start_seconds}-{end_seconds}.wav" "{os.path.join(self.root_path, display_label, ytid)}_{start_seconds}-{end_seconds}.wav"')
+        file_name = f'{ytid}_{start_seconds}-{end_seconds}'
+        ext = _FORMAT_EXT[self.format]
+        file_path = f'{label_dirs[0]}{os.sep}{file_name}.{ext}'
+        # a previous run may have downloaded the file without replicating it
+        if not os.path.exists(file_path):
+            self._ytdlp_download(ytid, f'{label_dirs[0]}{os.sep}{file_name}.%(ext)s', start_seconds, end_seconds)
+
+        if len(label_dirs) > 1:
+            # link the file in the other folders
+            if not os.path.exists(file_path):
+                return
+            for label_dir in label_dirs[1:]:
+                target = f'{label_dir}{os.sep}{file_name}.{ext}'
+                try:
+                    os.link(file_path, target)
+                except FileExistsError:
+                    pass
+                except OSError:
+                    # hardlinks are not possible across filesystems
+                    shutil.copyfile(file_path, target)
         return
+
+    def _ytdlp_download(
+            self,
+            ytid: str,
+            outtmpl: str,
+            start_seconds: float,
+            end_seconds: float,
+        ):
+        """
+        This method downloads and extracts the audio of a YouTube video in-process with the yt-dlp API.
+        Videos that are no longer available are skipped.
+        :param ytid: YouTube ID.
+        :param outtmpl: yt-dlp output template of the audio file.
+        :param start_seconds: start time of the audio clip.
+        :param end_seconds: end time of the audio clip.
+        """
+        ydl_opts = {
+            'format': 'bestaudio/best',
+            'outtmpl': outtmpl,
+            'postprocessors': [{
+                'key': 'FFmpegExtractAudio',
+                'preferredcodec': self.format,
+                'preferredquality': str(self.quality),
+            }],
+            # only fetch the clip section instead of trimming the whole stream after download
+            'download_ranges': yt_dlp.utils.download_range_func(None, [(start_seconds, end_seconds)]),
+            'concurrent_fragment_downloads': 4,
+            # share the player/signature cache between downloads and back off when rate limited
+            'cachedir': os.path.join(self.cache_dir, 'yt-dlp'),
+            'retries': 10,
+            'fragment_retries': 10,
+            'retry_sleep_functions': {'http': lambda n: min(2 ** n, 30)},
+            'sleep_interval_requests': 0.25,
+            'quiet': True,
+            'noprogress': True,
+            'no_warnings': True,
+            'logger': _TqdmLogger(),
+        }
+        try:
+            with yt_dlp.YoutubeDL(ydl_opts) as ydl:
+                ydl.download([f'https://www.youtube.com/watch?v={ytid}'])
+        except yt_dlp.utils.DownloadError:
+            pass
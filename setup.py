@@ -20,8 +20,8 @@ setup(
     long_description = long_description,
     long_description_content_type = "text/markdown",
     install_requires = [
-        "joblib",
         "pandas",
+        "tqdm",
         "yt-dlp",
     ],
     extras_require = {